@@ -7,65 +7,188 @@ Description:
     Scrapes entry level IT Support job postings on indeed
 """
 
+import asyncio
+from itertools import islice
 import sys
+from typing import Iterable, Iterator
 
-from bs4 import BeautifulSoup
-import requests
+import httpx
+from selectolax.lexbor import LexborHTMLParser, LexborNode
 import yaml
 
-def create_search_query(search_keys: list) -> str:
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    # PyYAML was built without libyaml, fall back to the pure Python loader
+    from yaml import SafeLoader
+
+US_JOBS_URL = "https://www.indeed.com/jobs"
+VIEWJOB_URL = "https://indeed.com/viewjob?jk="
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64; rv:107.0) Gecko/20100101 Firefox/107.0"
+# Discord rejects webhook messages carrying more embeds than this
+MAX_EMBEDS_PER_MESSAGE = 10
+EMBED_COLOR = 5814783
+EMBED_DESCRIPTION = "**Location**: {location}\n"\
+                    "**Company**: {company}\n"\
+                    "**Job Type**: {job_type}\n"\
+                    "**Salary**: {salary}"
+# Transient failures from indeed or discord are retried with exponential backoff
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+MAX_RETRIES = 5
+BACKOFF_FACTOR = 0.5
+# Filters applied to every indeed search, only the search terms differ per country
+SEARCH_FILTERS = {
+    "explvl": "entry_level",
+    "fromage": 1,
+    "jt": "fulltime",
+    "limit": 50
+}
+
+_JOBS_SELECTOR = "div.tapItem"
+# Every field of a job card is collected in a single pass over its result content
+_FIELDS_SELECTOR = "td.resultContent .jobTitle, "\
+                   "td.resultContent .companyName, "\
+                   "td.resultContent .companyLocation, "\
+                   "td.resultContent div.metadata"
+_FIELD_CLASSES = frozenset(('jobTitle', 'companyName', 'companyLocation', 'metadata'))
+
+def _job_title(job_title_header: LexborNode) -> str:
+    """
+    Finds the job title within the title header of a job card, skipping the
+    "new" badge span it may start with
+
+    Args:
+        job_title_header (LexborNode): The .jobTitle node of a job card
+    Returns:
+        job_title (str): The title of the job, empty if none was found
+    """
+    for span in job_title_header.css('span'):
+        job_title = span.text()
+        if job_title and job_title != 'new':
+            return job_title
+    return ""
+
+def _job_key(job_title_header: LexborNode) -> str:
+    """
+    Reads the indeed job key from the link within the title header of a job card
+
+    Args:
+        job_title_header (LexborNode): The .jobTitle node of a job card
+    Returns:
+        job_key (str): The data-jk attribute of the job link, empty if none was found
+    """
+    job_key = ""
+
+    # The job link is a direct child of the title header, no need to descend any further
+    for child in job_title_header.iter():
+        job_key = child.attributes.get('data-jk') or job_key
+    return job_key
+
+def create_search_query(search_keys: list) -> dict:
     """
-    Generates a URL encoded search query to be passed
-    to indeed
+    Generates the search query parameters to be passed
+    to indeed. Encoding is left to the HTTP client
 
     Args:
         search_keys (list[str]): Contains terms that will
         be searched for on indeed
     Returns:
-        search_query (str): The URL encoded search string
-        to be appended to the indeed URL.
+        search_query (dict): The query string parameters
+        for the indeed jobs URL.
     """
-    search_query = ""
+    search_query = {"q": " OR ".join(f'"{search_key}"' for search_key in search_keys)}
+    search_query.update(SEARCH_FILTERS)
+    return search_query
 
-    for idx, search_key in enumerate(search_keys, start=1):
-        if idx < len(search_keys):
-            search_query += f"%22{search_key}%22%20OR"
-        else:
-            search_query += f"%22{search_key}%22&"
+def create_session() -> httpx.AsyncClient:
+    """
+    Creates a session which is shared by every request made to indeed and discord
+    so that connections are pooled and kept alive between countries and postings.
+    HTTP/2 lets the concurrent discord posts share a single multiplexed connection
 
-    search_query += \
-        "explvl=entry_level&"\
-        "fromage=1&"\
-        "jt=fulltime&"\
-        "limit=50"
-    return search_query
+    Returns:
+        session (httpx.AsyncClient): Session with a default User-Agent and timeout
+    """
+    return httpx.AsyncClient(http2=True,
+                             limits=httpx.Limits(max_connections=20,
+                                                 max_keepalive_connections=10),
+                             timeout=10,
+                             follow_redirects=True,
+                             headers={"User-Agent": USER_AGENT})
+
+async def send_request(method: str, url: str, session: httpx.AsyncClient,
+                       **kwargs) -> httpx.Response:
+    """
+    Makes a request over the shared session, retrying connection errors, timeouts
+    and the statuses in RETRY_STATUSES. The delay doubles with every attempt unless
+    the server asks for a specific one through the Retry-After header
+
+    Args:
+        method (str): The HTTP method to use
+        url (str): The URL to send the request to
+        session (httpx.AsyncClient): Shared session used to make the request
+        **kwargs: Passed through to httpx, e.g. params or json
+    Returns:
+        response (httpx.Response): The final, successful response
+    Raises:
+        httpx.TransportError: The request still failed after the last retry
+        httpx.HTTPStatusError: The final response was not successful
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        delay = BACKOFF_FACTOR * 2 ** attempt
+        try:
+            response = await session.request(method, url, **kwargs)
+            if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                response.raise_for_status()
+                return response
 
-def get_data(query: str, country: str) -> str:
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.replace(".", "", 1).isdigit():
+                delay = float(retry_after)
+        except httpx.TransportError:
+            if attempt == MAX_RETRIES:
+                raise
+        await asyncio.sleep(delay)
+
+async def get_data(query: dict, country: str, session: httpx.AsyncClient) -> str:
     """
     Make a query to indeed and retrieve the html data
 
     Args:
-        query (str): The search query to be made on indeed
+        query (dict): The search query parameters to be sent to indeed
         country (str): Country code for indeed
+        session (httpx.AsyncClient): Shared session used to make the request
     Returns:
         resp (str): The html content of the response
+    Raises:
+        httpx.HTTPError: indeed could not be reached or did not return results
     """
     if country.lower() == 'us':
-        url = f"https://www.indeed.com/jobs?q={query}"
+        url = US_JOBS_URL
     else:
-        url = f"https://{country}.indeed.com/jobs?q={query}"
+        url = f"https://{country}.indeed.com/jobs"
 
-    try:
-        headers = {"User-Agent":"Mozilla/5.0 (X11; Linux x86_64; rv:107.0) Gecko/20100101 Firefox/107.0"}
-        resp = requests.get(url, headers=headers).content
-    except requests.ConnectionError as err:
-        print("Could not connect: ", err)
-        sys.exit(1)
-    return resp
+    response = await send_request("GET", url, session, params=query)
+    # Lexbor assumes UTF-8 for raw bytes, so decode here using the charset
+    # from the Content-Type header instead
+    return response.text
 
-def scrape_html(html_content: str) -> list:
+def parse_html(html_content: str) -> LexborHTMLParser:
+    """
+    Parses the HTML content returned by indeed
+
+    Args:
+        html_content (str): HTML data from indeed
+    Returns:
+        tree (LexborHTMLParser): The parsed page
+    """
+    # Lexbor keeps the whole tree in C, Python objects are only created
+    # for the nodes that get selected
+    return LexborHTMLParser(html_content)
+
+def iter_postings(tree: LexborHTMLParser) -> Iterator[dict]:
     """
-    Scrapes the HTML content and creates a list of job postings structured as follows:
+    Scrapes the parsed page and yields job postings one at a time, structured as follows:
         job_posting = {
             "title": str,
             "link": str,
@@ -75,67 +198,175 @@ def scrape_html(html_content: str) -> list:
             "salary": str,
         }
     Args:
-        html_content (str): String of HTML data from indeed:
-    Returns:
-        postings (list[dict]): Contains list of job postings stored in dicts
+        tree (LexborHTMLParser): The parsed page as returned by parse_html
+    Yields:
+        posting (dict): A single job posting
     """
-    postings = []
+    for job in tree.css(_JOBS_SELECTOR):
+        fields = {}
 
-    soup= BeautifulSoup(html_content, 'html.parser')
-    jobs = soup.findAll('div', class_='tapItem')
+        # Nodes come back in document order, the first one of each class wins
+        for node in job.css(_FIELDS_SELECTOR):
+            for class_name in _FIELD_CLASSES.intersection(node.attributes['class'].split()):
+                fields.setdefault(class_name, node)
 
-    for job in jobs:
-        job_content = job.find('td', class_='resultContent')
-        job_metadata = job_content.find('div', class_="metadata")
+        job_title_header = fields.get('jobTitle')
+        job_company = fields.get('companyName')
+        job_location = fields.get('companyLocation')
+        job_metadata = fields.get('metadata')
 
-        job_title_header = job_content.find(class_='jobTitle')
-        job_title_spans = job_title_header.find_all('span')
-        job_key = job_title_header.contents[-1]['data-jk']
+        # Cards that do not follow the usual layout are skipped rather than failing the page
+        if job_title_header is None or job_company is None or job_location is None:
+            continue
 
-        if job_title_spans[0].text == 'new':
-            job_title = job_title_spans[1].text
-        else:
-            job_title = job_title_spans[0].text
+        job_key = _job_key(job_title_header)
 
-        postings.append({
-                         "title": job_title,
-                         "link": f"https://indeed.com/viewjob?jk={job_key}",
-                         "company": job_content.find(class_='companyName').text,
-                         "location": job_content.find(class_='companyLocation').text,
-                         "job_type": "Full Time",
-                         "salary": job_metadata.text if job_metadata else ""
-                       })
+        # Without a key there is no link to the job, so the card cannot be published
+        if not job_key:
+            continue
 
-    return postings
+        yield {
+               "title": _job_title(job_title_header),
+               "link": VIEWJOB_URL + job_key,
+               "company": job_company.text(),
+               "location": job_location.text(),
+               "job_type": "Full Time",
+               "salary": job_metadata.text() if job_metadata is not None else ""
+             }
 
-def publish_to_discord(postings: list, webhook: str) -> None:
+def scrape_html(html_content: str) -> list:
+    """
+    Parses the HTML content and collects every job posting on the page. Meant to
+    run in a worker thread, the parsed page is released before it returns
+
+    Args:
+        html_content (str): HTML data from indeed
+    Returns:
+        postings (list[dict]): Job postings as yielded by iter_postings
+    """
+    return list(iter_postings(parse_html(html_content)))
+
+def build_embed(posting: dict) -> dict:
+    """
+    Builds the discord embed for a single job posting
+
+    Args:
+        posting (dict): Information about a job posting as yielded by iter_postings
+    Returns:
+        embed (dict): The embed to be included in a webhook payload
+    """
+    return {
+             "title": posting['title'],
+             "description": EMBED_DESCRIPTION.format_map(posting),
+             "url": posting['link'],
+             "color": EMBED_COLOR
+           }
+
+async def publish_to_discord(postings: Iterable[dict], webhook: str,
+                             session: httpx.AsyncClient) -> list:
     """
-    Writes an embed to the the discord webhook provided
+    Writes embeds to the the discord webhook provided, batching as many
+    postings into each message as discord allows
 
     Args:
-        postings (list[dict]): A list of dictionaries which each contain information
-                              about a job posting.
+        postings (Iterable[dict]): Dictionaries which each contain information
+                                   about a job posting.
         webhook (str): The discord webhook to which postings should be sent
+        session (httpx.AsyncClient): Shared session used to make the requests
+    Returns:
+        failed (list[dict]): The postings whose message discord did not accept
+    """
+    chunks = []
+    payloads = []
+    postings = iter(postings)
+
+    while chunk := list(islice(postings, MAX_EMBEDS_PER_MESSAGE)):
+        chunks.append(chunk)
+        payloads.append({
+                          "content": "",
+                          "embeds": [build_embed(posting) for posting in chunk]
+                        })
+
+    # A failed message must not cancel the others, each result is checked below
+    results = await asyncio.gather(*[send_request("POST", webhook, session, json=payload)
+                                     for payload in payloads],
+                                   return_exceptions=True)
+    failed = []
+
+    for chunk, payload, result in zip(chunks, payloads, results):
+        if isinstance(result, httpx.HTTPError):
+            print("Could not post to discord: ", result)
+            failed.extend(chunk)
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            print(payload)
+
+    return failed
+
+def remove_duplicates(postings: Iterable[dict], webhook: str, seen: set) -> Iterator[dict]:
+    """
+    Drops postings which were already published to the same webhook during this
+    run, e.g. jobs syndicated to several indeed countries sharing one channel
+
+    Args:
+        postings (Iterable[dict]): Job postings as yielded by iter_postings
+        webhook (str): The discord webhook the postings are meant for
+        seen (set[tuple]): (webhook, link) pairs which were already kept,
+                           updated in place
+    Yields:
+        posting (dict): A posting not yet published to the webhook
     """
     for posting in postings:
-        embed = {
-              "content": "",
-              "embeds": [
-                {
-                  "title": posting['title'],
-                  "description": f"**Location**: {posting['location']}\n"
-                                 f"**Company**: {posting['company']}\n"
-                                 f"**Job Type**: {posting['job_type']}\n"
-                                 f"**Salary**: {posting['salary']}",
-                  "url": posting['link'],
-                  "color": 5814783
-                }
-              ]
-            }
-
-        requests.post(webhook, json=embed)
-
-        print(embed)
+        key = (webhook, posting['link'])
+        if key not in seen:
+            seen.add(key)
+            yield posting
+
+async def handle_country(country: dict, session: httpx.AsyncClient, seen: set) -> bool:
+    """
+    Searches indeed for a single country and publishes the results to its webhook.
+    Failures are reported here so they do not interrupt the other countries
+
+    Args:
+        country (dict): A country entry from countries.yml
+        session (httpx.AsyncClient): Shared session used to make the requests
+        seen (set[tuple]): (webhook, link) pairs already published during this run
+    Returns:
+        success (bool): Whether the country was scraped and published
+    """
+    search_query = create_search_query(country['search_keys'])
+    try:
+        raw_content = await get_data(search_query, country['country'], session)
+    except httpx.HTTPError as err:
+        print("Could not get results from indeed: ", err)
+        return False
+    # Parsing and extraction are CPU bound, keep them off the event loop so other
+    # countries can progress
+    postings = await asyncio.to_thread(scrape_html, raw_content)
+    # Back on the event loop, so the shared set needs no locking
+    postings = remove_duplicates(postings, country['webhook'], seen)
+    # Postings in a message discord did not accept are already marked as seen, so
+    # they are lost for this run, including copies from other countries sharing
+    # the webhook. The country is reported as failed instead
+    failed = await publish_to_discord(postings, country['webhook'], session)
+    return not failed
+
+async def scrape_countries(countries: list) -> bool:
+    """
+    Scrapes and publishes every country concurrently over a single session
+
+    Args:
+        countries (list[dict]): The entries loaded from countries.yml
+    Returns:
+        success (bool): Whether every country was scraped and published
+    """
+    seen = set()
+
+    async with create_session() as session:
+        results = await asyncio.gather(*[handle_country(country, session, seen)
+                                         for country in countries])
+    return all(results)
 
 def main():
     """
@@ -143,16 +374,13 @@ def main():
     """
     try:
         with open('countries.yml', 'r') as countries_file:
-            countries = yaml.safe_load(countries_file)
+            countries = yaml.load(countries_file, Loader=SafeLoader)
     except FileNotFoundError:
         print("No countries.yml file found")
         sys.exit(1)
 
-    for country in countries:
-        search_query = create_search_query(country['search_keys'])
-        raw_content = get_data(search_query, country['country'])
-        postings = scrape_html(raw_content)
-        publish_to_discord(postings, country['webhook'])
+    if not asyncio.run(scrape_countries(countries)):
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()